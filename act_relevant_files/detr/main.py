@@ -47,6 +47,8 @@ def get_args_parser():
     parser.add_argument('--num_queries', default=400, type=int, # will be overridden
                         help="Number of query slots")
     parser.add_argument('--pre_norm', action='store_true')
+    parser.add_argument('--compile', action='store_true',
+                        help="Compile the model forward with torch.compile (fixed input shapes only)")
 
     # * Segmentation
     parser.add_argument('--masks', action='store_true',
@@ -123,6 +125,8 @@ def build_ACT_model_and_optimizer(args_override):
     args.masks = False
     args.dilation = False  # Default value for dilation
     args.pre_norm = False  # Default value for pre_norm
+    args.compile = False  # torch.compile the model forward
+    args.inference_only = False  # Skip building the CVAE encoder (training-only)
 
     # Override with any provided arguments
     if isinstance(args_override, dict):
@@ -5,7 +5,7 @@ DETR model and criterion classes.
 import torch
 from torch import nn
 from torch.autograd import Variable
-from .backbone import build_backbone
+from .backbone import build_backbone, fuse_frozen_batchnorm
 from .transformer import build_transformer, TransformerEncoder, TransformerEncoderLayer
 
 import numpy as np
@@ -21,14 +21,16 @@ def reparametrize(mu, logvar):
 
 
 def get_sinusoid_encoding_table(n_position, d_hid):
-    def get_position_angle_vec(position):
-        return [position / np.power(10000, 2 * (hid_j // 2) / d_hid) for hid_j in range(d_hid)]
+    # Vectorized: angle[pos, 2i] = angle[pos, 2i+1] = pos / 10000^(2i / d_hid)
+    pos = np.arange(n_position, dtype=np.float32)[:, None]
+    inv_freq = np.exp(-np.log(10000.0) * np.arange(0, d_hid, 2, dtype=np.float32) / d_hid)
+    angles = pos * inv_freq  # (n_position, ceil(d_hid / 2))
 
-    sinusoid_table = np.array([get_position_angle_vec(pos_i) for pos_i in range(n_position)])
-    sinusoid_table[:, 0::2] = np.sin(sinusoid_table[:, 0::2])  # dim 2i
-    sinusoid_table[:, 1::2] = np.cos(sinusoid_table[:, 1::2])  # dim 2i+1
+    sinusoid_table = np.empty((n_position, d_hid), dtype=np.float32)
+    sinusoid_table[:, 0::2] = np.sin(angles)  # dim 2i
+    sinusoid_table[:, 1::2] = np.cos(angles[:, :d_hid // 2])  # dim 2i+1
 
-    return torch.FloatTensor(sinusoid_table).unsqueeze(0)
+    return torch.from_numpy(sinusoid_table).unsqueeze(0)
 
 
 class DETRVAE(nn.Module):
@@ -38,6 +40,8 @@ class DETRVAE(nn.Module):
         Parameters:
             backbones: torch module of the backbone to be used. See backbone.py
             transformer: torch module of the transformer architecture. See transformer.py
+            encoder: CVAE encoder (TransformerEncoder). Pass None to build an inference-only model
+                     without any of the VAE encoder submodules.
             state_dim: robot state dimension of the environment
             num_queries: number of object queries, ie detection slot. This is the maximal number of objects
                          DETR can detect in a single image. For COCO, we recommend 100 queries.
@@ -75,11 +79,14 @@ class DETRVAE(nn.Module):
             self.backbones = None
 
         # encoder extra parameters
-        self.cls_embed = nn.Embedding(1, hidden_dim) # extra cls token embedding
-        self.encoder_action_proj = nn.Linear(self.num_actions, hidden_dim) # project action to embedding
-        self.encoder_joint_proj = nn.Linear(state_dim, hidden_dim)  # project qpos to embedding
-        self.latent_proj = nn.Linear(hidden_dim, 2 * self.latent_dim)
-        self.pos_table = get_sinusoid_encoding_table(1+1+num_queries, hidden_dim).to(self.device)
+        if encoder is not None:
+            self.cls_embed = nn.Embedding(1, hidden_dim) # extra cls token embedding
+            self.encoder_action_proj = nn.Linear(self.num_actions, hidden_dim) # project action to embedding
+            self.encoder_joint_proj = nn.Linear(state_dim, hidden_dim)  # project qpos to embedding
+            self.latent_proj = nn.Linear(hidden_dim, 2 * self.latent_dim)
+            self.register_buffer('pos_table', get_sinusoid_encoding_table(1+1+num_queries, hidden_dim), persistent=False)
+        else:
+            self._clear_vae_encoder()
 
         # decoder extra parameters
         self.latent_out_proj = nn.Linear(self.latent_dim, hidden_dim)
@@ -87,11 +94,36 @@ class DETRVAE(nn.Module):
 
         # Move all parameters to device
         self.to(self.device)
-        print(f"Latent projection: {self.latent_proj.in_features}->{self.latent_proj.out_features}")
-        # Should show: 512->64 (for latent_dim=32)
+        if self.latent_proj is not None:
+            print(f"Latent projection: {self.latent_proj.in_features}->{self.latent_proj.out_features}")
+            # Should show: 512->64 (for latent_dim=32)
         print(f"Output projection: {self.latent_out_proj.in_features}->{self.latent_out_proj.out_features}")
         # Should show: 32->512
 
+    def _clear_vae_encoder(self):
+        self.encoder = None
+        self.cls_embed = None
+        self.encoder_action_proj = None
+        self.encoder_joint_proj = None
+        self.latent_proj = None
+        self.pos_table = None
+
+    def strip_vae_encoder(self):
+        """ Drop the CVAE encoder and its projections, which are only used at training time.
+        At inference the latent is always zeros, so this frees their memory without changing outputs.
+        Load the full checkpoint before calling this, as the stripped keys are no longer expected.
+        """
+        self._clear_vae_encoder()
+        return self
+
+    def fuse_backbone_batchnorm(self):
+        """ Fold the backbones' frozen batch norms into their convs for inference (see fuse_frozen_batchnorm).
+        Like strip_vae_encoder, call this after loading the checkpoint, as the folded keys are no longer expected.
+        """
+        if self.backbones is not None:
+            fuse_frozen_batchnorm(self.backbones)
+        return self
+
     def forward(self, qpos, image, env_state, actions=None, is_pad=None):
         """
         qpos: batch, qpos_dim
@@ -100,6 +132,8 @@ class DETRVAE(nn.Module):
         actions: batch, seq, action_dim
         """
         is_training = actions is not None  # train or val
+        if is_training and self.encoder is None:
+            raise RuntimeError("VAE encoder has been stripped, this model can only be used for inference")
         bs, _ = qpos.shape
         ### Obtain latent z from action sequence
         if is_training:
@@ -112,31 +146,31 @@ class DETRVAE(nn.Module):
             if qpos_embed.dim() == 2:
                 qpos_embed = qpos_embed.unsqueeze(1)  # now [bs, 1, hidden_dim]
 
-            cls_embed = self.cls_embed.weight  # (1, hidden_dim)
-            cls_embed = cls_embed.unsqueeze(0).repeat(bs, 1, 1)  # (bs, 1, hidden_dim)
-
-            # Concatenate along sequence dimension: expected shape (bs, 1 + 1 + seq_len_action, hidden_dim)
-            encoder_input = torch.cat([cls_embed, qpos_embed, action_embed], axis=1)
+            # Concatenate along sequence dimension: expected shape (bs, 1 + 1 + seq_len_action, hidden_dim).
+            # Fill one preallocated tensor instead of repeat + cat; the CLS row (1, hidden_dim) broadcasts over bs.
+            encoder_input = action_embed.new_empty(bs, 2 + action_embed.size(1), action_embed.size(2))
+            encoder_input[:, 0] = self.cls_embed.weight
+            encoder_input[:, 1] = qpos_embed[:, 0]
+            encoder_input[:, 2:] = action_embed
             # print("DEBUG: encoder_input.shape =", encoder_input.shape)  # e.g. [bs, 3, hidden_dim]
-            encoder_input = encoder_input.permute(1, 0, 2)  # now shape -> (seq, bs, hidden_dim)
-            seq_len = encoder_input.size(0)
+            # The encoder is batch-first (see build_encoder), so no permute to (seq, bs, hidden_dim) is needed
+            seq_len = encoder_input.size(1)
             # print("DEBUG: seq_len =", seq_len)
 
-            # Adjust positional encoding's length to match seq_len
-            pos_embed = self.pos_table.clone().detach()  # initially shape: (1, total_seq_len, hidden_dim)
-            pos_embed = pos_embed[:, :seq_len, :]          # slice to match encoder input (1, seq, hidden_dim)
-            pos_embed = pos_embed.permute(1, 0, 2)           # now: (seq, 1, hidden_dim)
+            # Adjust positional encoding's length to match seq_len. pos_table is a buffer (no grad) and the
+            # encoder never writes to pos, so a sliced view is enough - no clone needed.
+            pos_embed = self.pos_table[:, :seq_len]  # (1, seq, hidden_dim), broadcasts over bs
             # print("DEBUG: pos_embed.shape =", pos_embed.shape)
 
             # Do not mask CLS token.
-            cls_joint_is_pad = torch.full((bs, 2), False).to(qpos.device)  # (bs, 2)
+            cls_joint_is_pad = is_pad.new_zeros((bs, 2), dtype=torch.bool)  # (bs, 2), allocated on is_pad's device
             if is_pad.dim() == 1:
                 is_pad = is_pad.unsqueeze(1)  # Add sequence dimension if missing
             is_pad = torch.cat([cls_joint_is_pad, is_pad], axis=1)  # (bs, 2 + action_seq_length)
 
             # Query transformer.
             encoder_output = self.encoder(encoder_input, pos=pos_embed, src_key_padding_mask=is_pad)
-            encoder_output = encoder_output[0]  # take CLS output only
+            encoder_output = encoder_output[:, 0]  # take CLS output only
             latent_info = self.latent_proj(encoder_output)  # [batch, latent_dim*2]
             mu = latent_info[:, :self.latent_dim]  # [batch, latent_dim]
             logvar = latent_info[:, self.latent_dim:2*self.latent_dim]  # [batch, latent_dim]
@@ -156,24 +190,40 @@ class DETRVAE(nn.Module):
             latent_input = self.latent_out_proj(latent_sample)
         else:
             mu = logvar = None
-            latent_sample = torch.zeros([bs, self.latent_dim], dtype=torch.float32).to(qpos.device)
+            # Allocated directly on the device (no host->device copy, so this is CUDA-graph capturable)
+            latent_sample = qpos.new_zeros(bs, self.latent_dim, dtype=torch.float32)
             latent_input = self.latent_out_proj(latent_sample)
 
         if self.backbones is not None:
             # Image observation features and position embeddings.
-            all_cam_features = []
-            all_cam_pos = []
-            for cam_id, cam_name in enumerate(self.camera_names):
-                features, pos = self.backbones[cam_id](image[:, cam_id])  # HARDCODED
-                features = features[0]  # take the last layer feature
+            num_cams = len(self.camera_names)
+            if num_cams == 1:
+                # Single camera: no per-camera lists or concatenation needed.
+                features, pos = self.backbones[0](image[:, 0])
+                src = self.input_proj(features[0])  # take the last layer feature
                 pos = pos[0]
-                all_cam_features.append(self.input_proj(features))
-                all_cam_pos.append(pos)
+            elif len(self.backbones) == 1:
+                # Cameras share one backbone (see build()): run them as a single (bs * num_cams) batch,
+                # then fold the camera dimension into the width dimension, matching a per-camera cat on axis 3.
+                features, pos = self.backbones[0](image.flatten(0, 1))
+                features = self.input_proj(features[0])  # (bs * num_cams, hidden, h, w)
+                _, hidden, h, w = features.shape
+                src = features.view(bs, num_cams, hidden, h, w).permute(0, 2, 3, 1, 4).reshape(bs, hidden, h, num_cams * w)
+                pos = pos[0][:1].repeat(1, 1, 1, num_cams)  # position embedding is identical for every image
+            else:
+                all_cam_features = []
+                all_cam_pos = []
+                for cam_id, cam_name in enumerate(self.camera_names):
+                    features, pos = self.backbones[cam_id](image[:, cam_id])
+                    features = features[0]  # take the last layer feature
+                    pos = pos[0]
+                    all_cam_features.append(self.input_proj(features))
+                    all_cam_pos.append(pos)
+                # Fold camera dimension into width dimension.
+                src = torch.cat(all_cam_features, axis=3)
+                pos = torch.cat(all_cam_pos, axis=3)
             # Proprioception features.
             proprio_input = self.input_proj_robot_state(qpos)
-            # Fold camera dimension into width dimension.
-            src = torch.cat(all_cam_features, axis=3)
-            pos = torch.cat(all_cam_pos, axis=3)
             hs = self.transformer(src, None, self.query_embed.weight, pos, latent_input, proprio_input, self.additional_pos_embed.weight)[0]
         else:
             qpos = self.input_proj_robot_state(qpos)
@@ -181,24 +231,12 @@ class DETRVAE(nn.Module):
             transformer_input = torch.cat([qpos, env_state], axis=1)  # seq length = 2
             hs = self.transformer(transformer_input, None, self.query_embed.weight, self.pos.weight)[0]
 
+        # Transformer.forward always returns hs as [batch, num_queries, hidden_dim], so select the first query
+        # directly (no shape sniffing, which also misfired when batch == num_queries) and only run the heads on it
+        hs = hs[:, 0]
         a_hat = self.action_head(hs)
         is_pad_hat = self.is_pad_head(hs)
 
-        # Select the appropriate token based on the shape of hs
-        if hs.dim() == 3:
-            if hs.size(0) == self.num_queries:
-                # hs is of shape [num_queries, batch, output_dim]
-                a_hat = a_hat[0]
-                is_pad_hat = is_pad_hat[0]
-            elif hs.size(1) == self.num_queries:
-                # hs is of shape [batch, num_queries, output_dim]
-                a_hat = a_hat[:, 0]
-                is_pad_hat = is_pad_hat[:, 0]
-            else:
-                raise Exception(f"Unexpected query dimension in hs: {hs.shape}")
-        else:
-            raise Exception(f"hs must be 3-dimensional, got shape: {hs.shape}")
-
         return a_hat, is_pad_hat, [mu, logvar]
 
 
@@ -281,8 +319,9 @@ def build_encoder(args):
     normalize_before = args.pre_norm # False
     activation = "relu"
 
+    # Batch-first so DETRVAE can feed its (bs, seq, hidden_dim) encoder input and pos_table without permutes
     encoder_layer = TransformerEncoderLayer(d_model, nhead, dim_feedforward,
-                                            dropout, activation, normalize_before)
+                                            dropout, activation, normalize_before, batch_first=True)
     encoder_norm = nn.LayerNorm(d_model) if normalize_before else None
     encoder = TransformerEncoder(encoder_layer, num_encoder_layers, encoder_norm)
 
@@ -304,7 +343,7 @@ def build(args):
 
     transformer = build_transformer(args)
 
-    encoder = build_encoder(args)
+    encoder = None if getattr(args, 'inference_only', False) else build_encoder(args)
 
     model = DETRVAE(
         backbones,
@@ -318,6 +357,11 @@ def build(args):
         latent_dim=args.latent_dim,
     ).to(args.device)
 
+    if getattr(args, 'compile', False):
+        # Module.compile() compiles forward in place, so state_dict keys don't get the '_orig_mod.' prefix
+        # and checkpoints stay interchangeable with eager models. Shapes are fixed (num_queries, camera count).
+        model.compile(mode="reduce-overhead", dynamic=False)
+
     n_parameters = sum(p.numel() for p in model.parameters() if p.requires_grad)
     print("number of parameters: %.2fM" % (n_parameters/1e6,))
 
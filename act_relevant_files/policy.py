@@ -11,6 +11,10 @@ from detr.main import build_ACT_model_and_optimizer, build_CNNMLP_model_and_opti
 from detr.util.misc import nested_tensor_from_tensor_list
 e = IPython.embed
 
+# ImageNet statistics the ResNet backbones were pretrained with; images are normalized with these in __call__
+IMAGE_MEAN = [0.485, 0.456, 0.406]
+IMAGE_STD = [0.229, 0.224, 0.225]
+
 
 class ACTPolicy(nn.Module):
     def __init__(self, args_override):
@@ -30,8 +34,7 @@ class ACTPolicy(nn.Module):
 
     def __call__(self, qpos, image, actions=None, is_pad=None):
         env_state = None
-        normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                         std=[0.229, 0.224, 0.225])
+        normalize = transforms.Normalize(mean=IMAGE_MEAN, std=IMAGE_STD)
         image = normalize(image)
 
         # Convert to nested tensor if needed
@@ -1,6 +1,7 @@
 import os
 import sys
 import time
+import threading
 from datetime import datetime
 
 import torch
@@ -23,7 +24,8 @@ sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__f
 
 # Instead of defining SequencePolicy, we use ACTPolicy
 from act_relevant_files.policy import ACTPolicy
-from .pybullet_utils import set_joint_angles_instantly, get_dummy_image
+from .pybullet_utils import set_joint_angles_instantly, get_controlled_joints, get_dummy_image
+from .policy_export import export_torchscript
 
 
 # Instead of using dataset directly, let's define constants
@@ -53,6 +55,34 @@ all_greet_action_lines = [
     {'l_ank_roll': 0.0, 'r_ank_roll': 0.0, 'l_ank_pitch': 0.5864306186666667, 'r_ank_pitch': -0.5864306186666667, 'l_knee': 1.0890854346666667, 'r_knee': -1.0890854346666667, 'l_hip_pitch': -0.7120943226666667, 'r_hip_pitch': 0.7120943226666667, 'l_hip_roll': 0.0, 'r_hip_roll': 0.0, 'l_hip_yaw': 0.0, 'r_hip_yaw': 0.0, 'l_sho_pitch': 0.16755160533333335, 'r_sho_pitch': -0.16755160533333335, 'l_sho_roll': 1.3823007440000001, 'r_sho_roll': -1.3823007440000001, 'l_el_pitch': 0.0, 'r_el_pitch': 0.0, 'l_el_yaw': -1.8011797573333335, 'r_el_yaw': 1.8011797573333335, 'l_gripper': 0.0, 'r_gripper': 0.0}
 ]
 
+
+def action_lines_to_tensor(action_lines):
+    """Convert a list of {joint_name: angle} dicts to a (len, 24) tensor in JOINT_ORDER, 0.0 for missing joints"""
+    return torch.tensor([[line.get(name, 0.0) for name in JOINT_ORDER] for line in action_lines], dtype=torch.float32)
+
+
+def cpu_state_dict(module):
+    """Snapshot a module's state_dict as detached CPU copies that later optimizer steps cannot modify"""
+    return OrderedDict((k, v.detach().to('cpu', copy=True)) for k, v in module.state_dict().items())
+
+
+def save_checkpoint_async(obj, path, pending_saves):
+    """torch.save obj to path on a background thread so disk I/O stays off the training loop.
+
+    pending_saves maps path -> thread; an earlier save to the same path is joined first so two writers never
+    share a file. Join every thread in pending_saves before exiting.
+    """
+    previous = pending_saves.get(path)
+    if previous is not None:
+        previous.join()
+    thread = threading.Thread(target=torch.save, args=(obj, path), daemon=True)
+    thread.start()
+    pending_saves[path] = thread
+
+
+# Precomputed once at import so datasets and validation index a tensor instead of per-joint dict lookups
+_GREET_TENSOR = action_lines_to_tensor(all_greet_action_lines)  # (L, 24)
+
 # Modified dataset class for sequence prediction
 class ServoDataset(Dataset):
     """Dataset for sequence prediction with sliding window"""
@@ -61,22 +91,31 @@ class ServoDataset(Dataset):
         # Add these as instance variables if you need them
         self.action_mean = ACTION_MEAN
         self.action_std = ACTION_STD
-        # Convert each sequence from list of dicts to list of tensors
+        # Each sequence is a (len, 24) tensor; lists of action dicts are converted once
         self.action_sequences = [
-            [self.dict_to_tensor(step) for step in seq]
+            seq if torch.is_tensor(seq) else action_lines_to_tensor(seq)
             for seq in action_sequences
         ]
         self.window_size = window_size
-        self.images = torch.rand(num_samples, 1, 3, image_size, image_size) if use_real_images else torch.zeros(num_samples, 1, 3, image_size, image_size)
-
-        # Create sequence targets with proper windowing
-        self.targets = []
-        for _ in range(num_samples):
-            seq_idx = np.random.randint(0, len(self.action_sequences))
-            seq = self.action_sequences[seq_idx]
-            start = np.random.randint(0, len(seq) - self.window_size + 1)
-            window = seq[start:start + self.window_size]
-            self.targets.append(torch.stack(window))
+        # Images are synthetic, so generate them per sample in __getitem__ rather than storing num_samples of them.
+        # Random images are seeded per index so a given sample sees the same image every epoch.
+        self.num_samples = num_samples
+        self.image_size = image_size
+        self._image_seed = np.random.randint(0, 2**31 - 1)
+        self._zero_image = torch.zeros(1, 3, image_size, image_size)
+
+        # Create sequence targets with proper windowing, sampling all windows in one vectorized gather.
+        # Sequences are padded to a common length; each start is drawn within its own sequence so padding is never read.
+        seqs = nn.utils.rnn.pad_sequence(self.action_sequences, batch_first=True)  # (S, L, D)
+        seq_lengths = np.array([len(seq) for seq in self.action_sequences])
+        if (seq_lengths < self.window_size).any():
+            raise ValueError(f"Every action sequence needs at least window_size={self.window_size} steps, "
+                             f"got lengths {seq_lengths.tolist()}")
+        seq_ids = np.random.randint(0, len(self.action_sequences), num_samples)
+        starts = (np.random.rand(num_samples) * (seq_lengths[seq_ids] - self.window_size + 1)).astype(np.int64)
+        offsets = starts[:, None] + np.arange(self.window_size)[None, :]  # (N, W)
+        self.targets = seqs[torch.from_numpy(seq_ids)[:, None], torch.from_numpy(offsets)]  # (N, W, D), contiguous
+        self._qpos_zero = torch.zeros(len(JOINT_ORDER))  # Shared qpos returned by every sample (collate copies it)
 
         # Add data augmentation configuration
         self.use_real_images = use_real_images
@@ -87,35 +126,32 @@ class ServoDataset(Dataset):
         ])
 
 
-    def dict_to_tensor(self, action_dict):
-        return torch.tensor([
-            action_dict.get(name, 0.0)  # Use 0.0 as default for missing joints
-            for name in JOINT_ORDER
-        ], dtype=torch.float32)
-
-
     def __len__(self):
-        return len(self.images)
+        return self.num_samples
 
 
     def __getitem__(self, idx):
         """Returns a single sample from the dataset."""
-        image = self.images[idx]  # Now shape is [1, 3, H, W]
-
-        # Only apply augmentations if image isn't black or allowed explicitly
-        if not self.use_real_images and torch.all(image == 0):
-            pass
+        # Only random images are augmented, black images are shared and returned as is
+        if not self.use_real_images:
+            image = self._zero_image  # [1, 3, H, W]
         else:
+            generator = torch.Generator().manual_seed(self._image_seed + int(idx))
+            image = torch.rand(3, self.image_size, self.image_size, generator=generator)  # [3, H, W]
             # Apply augmentations to each camera view separately
-            image = image.squeeze(0)  # [3, H, W]
             image = self.augment(image)
-            image = image.unsqueeze(0)  # Back to [1, 3, H, W]
+            image = image.unsqueeze(0)  # [1, 3, H, W]
 
-        return image, torch.zeros(24), self.targets[idx]
+        return image, self._qpos_zero, self.targets[idx]
 
 
-def train(policy, train_loader, num_epochs=50, lr=1e-4, device='cpu', policy_config=None, args=None):
-    scaler = torch.cuda.amp.GradScaler()  # Add mixed precision
+def train(policy, train_loader, num_epochs=50, lr=1e-4, device='cpu', policy_config=None, args=None, accum_steps=1):
+    """accum_steps: number of batches whose gradients are accumulated per optimizer step"""
+    device = torch.device(device)
+    # Mixed precision on CUDA: bf16 where supported (no loss scaling needed), otherwise fp16 with a GradScaler
+    use_amp = device.type == 'cuda'
+    amp_dtype = torch.bfloat16 if use_amp and torch.cuda.is_bf16_supported() else torch.float16
+    scaler = torch.cuda.amp.GradScaler(enabled=use_amp and amp_dtype == torch.float16)
     optimizer = torch.optim.Adam(policy.parameters(), lr=lr, weight_decay=1e-5)
     # More balanced weighting for problem joints
     loss_weights = torch.ones(24)
@@ -127,6 +163,7 @@ def train(policy, train_loader, num_epochs=50, lr=1e-4, device='cpu', policy_con
     criterion = nn.SmoothL1Loss(reduction='none')  # Remove weight parameter
     best_loss = float('inf')
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    pending_saves = {}  # checkpoint path -> background save thread
 
     # Add learning rate scheduler
     scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(
@@ -143,50 +180,60 @@ def train(policy, train_loader, num_epochs=50, lr=1e-4, device='cpu', policy_con
     for epoch in range(num_epochs):
         epoch_start_time = time.time()
         policy.train()
-        total_loss = 0  # Reset each epoch
-        joint_errors = {name: 0.0 for name in JOINT_ORDER}
+        # Accumulate on device and sync once per epoch instead of calling .item() per joint per batch
+        total_loss = torch.zeros((), device=device)  # Reset each epoch
+        joint_error_sums = torch.zeros(len(JOINT_ORDER), device=device)
+        optimizer.zero_grad(set_to_none=True)  # skip the memset, backward writes fresh grads
 
         for batch_idx, (images, qpos, targets) in enumerate(train_loader):
-            images = images.to(device)
-            qpos = qpos.to(device)
-            targets = targets.to(device)  # shape: [B, window_size, 24]
+            images = images.to(device, non_blocking=True)
+            qpos = qpos.to(device, non_blocking=True)
+            targets = targets.to(device, non_blocking=True)  # shape: [B, window_size, 24]
+            # Only predict first timestep for now; slice once into a contiguous [B, 24] reused by loss and errors
+            current_targets = targets[:, 0].contiguous()
 
-            with torch.cuda.amp.autocast():
-                # Reshape targets to match policy output
-                current_targets = targets[:, 0, :]  # Only predict first timestep for now
+            with torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp):
                 preds = policy(qpos, images)  # shape: [B, 24]
                 loss = (criterion(preds, current_targets) * loss_weights.to(device)).mean()
 
-            optimizer.zero_grad()
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(policy.parameters(), 1.0)
-            optimizer.step()
+            # Average gradients over the batches of this accumulation group (the last group of an epoch may be
+            # shorter than accum_steps); the logged loss stays per-batch
+            group_start = batch_idx - batch_idx % accum_steps
+            group_size = min(accum_steps, len(train_loader) - group_start)
+            scaler.scale(loss / group_size).backward()
+            if batch_idx + 1 == group_start + group_size:
+                scaler.unscale_(optimizer)  # Clip the real gradients, not the scaled ones
+                torch.nn.utils.clip_grad_norm_(policy.parameters(), 1.0)
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
 
-            total_loss += loss.item()
+            total_loss += loss.detach()
 
             # Calculate per-joint errors
             with torch.no_grad():
-                errors = torch.abs(preds - current_targets).mean(dim=0)  # Average over batch
-                for i, name in enumerate(JOINT_ORDER):
-                    joint_errors[name] += errors[i].item()
+                joint_error_sums += torch.abs(preds - current_targets).mean(dim=0)  # Average over batch
 
             # Log batch metrics
             wandb.log({
-                "batch_loss": loss.item(),
+                "batch_loss": loss.item(),  # the only per-batch sync
                 "learning_rate": optimizer.param_groups[0]['lr'],
                 "epoch_progress": epoch + (batch_idx+1)/len(train_loader)
             })
 
+        total_loss = total_loss.item()
+        joint_errors = dict(zip(JOINT_ORDER, joint_error_sums.tolist()))
+
         # Save checkpoint every 10 epochs
         if epoch % 10 == 0:
             if not os.path.exists('checkpoints'):
                 os.makedirs('checkpoints', exist_ok=True)  # Create directory if needed
             ckpt_path = os.path.join('checkpoints', f'policy_epoch{epoch}_{timestamp}.pth')
-            torch.save({
-                'model_state': policy.state_dict(),
+            save_checkpoint_async({
+                'model_state': cpu_state_dict(policy),
                 'config': policy_config,  # Add config to checkpoint
                 'training_args': vars(args)
-            }, ckpt_path)
+            }, ckpt_path, pending_saves)
 
         # Update learning rate
         scheduler.step(total_loss / len(train_loader))
@@ -210,13 +257,8 @@ def train(policy, train_loader, num_epochs=50, lr=1e-4, device='cpu', policy_con
 
         # Log sample predictions
         with torch.no_grad():
-            sample_img, sample_qpos, sample_target = next(iter(train_loader))
-            # Ensure sample_img has correct shape [B, num_cam, C, H, W]
-            if sample_img.dim() == 4:
-                sample_img = sample_img.unsqueeze(1)
-            if sample_img.shape[2] == 1:
-                sample_img = sample_img.repeat(1, 1, 3, 1, 1)
-            sample_pred = preds[0].cpu()  # Just take first batch item
+            # Reuse the last training batch rather than building a new DataLoader iterator every epoch
+            sample_pred = preds[0].float().cpu()  # Just take first batch item
             sample_target = current_targets[0].cpu()  # First batch item of current timestep
 
             # Denormalize before logging
@@ -239,11 +281,11 @@ def train(policy, train_loader, num_epochs=50, lr=1e-4, device='cpu', policy_con
         # Update best model
         if avg_loss < best_loss:
             best_loss = avg_loss
-            torch.save({
-                'model_state': policy.state_dict(),
+            save_checkpoint_async({
+                'model_state': cpu_state_dict(policy),
                 'config': policy_config,  # Add config to checkpoint
                 'training_args': vars(args)
-            }, os.path.join(os.path.dirname(__file__), f'best_policy_{timestamp}.pth'))
+            }, os.path.join(os.path.dirname(__file__), f'best_policy_{timestamp}.pth'), pending_saves)
 
         # After completing epoch training:
         if epoch % GREET_VAL_FREQ == 0:
@@ -256,7 +298,7 @@ def train(policy, train_loader, num_epochs=50, lr=1e-4, device='cpu', policy_con
             # Update best greet error
             if greet_mse < best_greet_error:
                 best_greet_error = greet_mse
-                torch.save(policy.state_dict(), f'best_greet_policy_{timestamp}.pth')
+                save_checkpoint_async(cpu_state_dict(policy), f'best_greet_policy_{timestamp}.pth', pending_saves)
 
         if epoch % PYBLET_VAL_FREQ == 0:
             print("\nRunning PyBullet evaluation...")
@@ -276,6 +318,10 @@ def train(policy, train_loader, num_epochs=50, lr=1e-4, device='cpu', policy_con
         mins, secs = divmod(epoch_time, 60)
         print(f'Epoch {epoch} took: {int(mins)}m {secs:.1f}s | Loss: {avg_loss:.7f}')
 
+    # Make sure every checkpoint is fully written before returning
+    for thread in pending_saves.values():
+        thread.join()
+
     total_time = time.time() - total_start_time
     hours, rem = divmod(total_time, 3600)
     mins, secs = divmod(rem, 60)
@@ -286,8 +332,7 @@ def validate_greet_sequence(policy, device='cpu'):
     """Evaluate policy on known GREET sequence without PyBullet"""
     # TODO untested
     policy.eval()
-    greet_targets = torch.stack([torch.tensor([step[name] for name in JOINT_ORDER])
-                               for step in all_greet_action_lines])
+    greet_targets = _GREET_TENSOR
 
     with torch.no_grad():
         # Create dummy inputs matching training format
@@ -315,6 +360,7 @@ def evaluate_in_pybullet(policy, device='cpu'):
     robot = p.loadURDF("/home/ben/all_projects/ainex_private_ws/ainex_private/src/ainex_simulations/ainex_description/urdf/ainex.urdf",
                       [0, 0, 0.25],
                       useFixedBase=False)  # Match your training setup
+    controlled_joints = get_controlled_joints(robot)
 
     metrics = {
         'com_deviation': [],
@@ -331,7 +377,7 @@ def evaluate_in_pybullet(policy, device='cpu'):
 
         # Apply action
         joint_targets = {name: action[i] for i, name in enumerate(JOINT_ORDER)}
-        set_joint_angles_instantly(robot, joint_targets)
+        set_joint_angles_instantly(robot, joint_targets, controlled_joints)
         p.stepSimulation()
 
         # Calculate metrics
@@ -364,21 +410,29 @@ def main():
                       help='Use real images instead of black, enables augmentation')
     parser.add_argument('--wandb_project', type=str, default='imitate_johnny_act',
                       help='Weights & Biases project name')
+    parser.add_argument('--compile', action='store_true',
+                      help='Compile the ACT model with torch.compile')
+    parser.add_argument('--accum_steps', type=int, default=1,
+                      help='Batches to accumulate gradients over per optimizer step (effective batch = batch_size * accum_steps)')
     args = parser.parse_args()
 
     # Set device
     device = torch.device(args.device)
     print(f"Training on {device}")
+    # Allow TF32 tensor cores for the float32 nn.Linear layers in the transformer
+    torch.set_float32_matmul_precision('high')
 
     # Create synthetic dataset
-    greet_sequences = [all_greet_action_lines]  # Can add more sequences
+    greet_sequences = [_GREET_TENSOR]  # Can add more sequences
     dataset = ServoDataset(
         action_sequences=greet_sequences,
         num_samples=5000,
         use_real_images=args.use_real_images,
         window_size=5
     )
-    train_loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True)
+    # Workers generate/augment images in parallel; pinned batches let train() copy to the GPU with non_blocking=True
+    train_loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, num_workers=2,
+                              pin_memory=(device.type == 'cuda'), persistent_workers=True)
 
     # Configure ACTPolicy to mimic the original SequencePolicy behavior
     policy_config = {
@@ -400,6 +454,10 @@ def main():
     }
 
     policy = ACTPolicy(policy_config).to(device)
+    if args.compile:
+        # Compiled here rather than via policy_config['compile'], since policy_config is saved as the checkpoint
+        # config and loaders would otherwise always get a compiled model. In place, so state_dict keys are unchanged.
+        policy.model.compile(mode="reduce-overhead", dynamic=False)
 
     # Initialize WandB
     wandb.init(
@@ -411,11 +469,13 @@ def main():
             "hidden_dim": policy_config['hidden_dim'],
             "dim_feedforward": policy_config['dim_feedforward'],
             "window_size": dataset.window_size,
-            "use_real_images": args.use_real_images
+            "use_real_images": args.use_real_images,
+            "accum_steps": args.accum_steps
         }
     )
 
-    train(policy, train_loader, num_epochs=args.num_epochs, lr=args.lr, device=device, policy_config=policy_config, args=args)
+    train(policy, train_loader, num_epochs=args.num_epochs, lr=args.lr, device=device, policy_config=policy_config, args=args,
+          accum_steps=args.accum_steps)
 
     # Save trained policy with timestamp and epochs
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -426,6 +486,19 @@ def main():
         'training_args': vars(args)
     }, save_path)
 
+    # Export a TorchScript version for deployment without the Python DETR module tree
+    sample_image, sample_qpos, _ = dataset[0]
+    export_policy = policy
+    if args.compile:
+        # torch.jit.trace can't trace a dynamo-compiled forward, so trace an eager copy with the trained weights
+        export_policy = ACTPolicy(policy_config).to(device)
+        export_policy.load_state_dict(policy.state_dict())
+    try:
+        export_torchscript(export_policy, sample_qpos.unsqueeze(0).to(device), sample_image.unsqueeze(0).to(device),
+                           save_path.replace('.pth', '_ts.pt'))
+    except Exception as e:
+        print(f"TorchScript export failed: {str(e)}")
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,40 @@
+# Export helpers shared by the training script and the pybullet runner (no training-only imports here)
+import inspect
+
+import torch
+from torch import nn
+
+
+class ACTInferenceWrapper(nn.Module):
+    """Inference-only view of an ACTPolicy that returns just the action tensor, so it can be traced"""
+    def __init__(self, policy):
+        super().__init__()
+        self.policy = policy
+
+    def forward(self, qpos, image):
+        return self.policy(qpos, image)
+
+
+def export_torchscript(policy, sample_qpos, sample_image, save_path):
+    """Trace the policy in eval mode with a sample batch and save it as a TorchScript module.
+    Tracing bakes in the sample's shapes (including batch size), so trace with the deployment shape."""
+    policy.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(ACTInferenceWrapper(policy), (sample_qpos, sample_image), strict=False)
+    traced.save(save_path)
+    print(f"Saved TorchScript policy to {save_path}")
+    return traced
+
+
+def export_onnx(policy, sample_qpos, sample_image, save_path, opset_version=17):
+    """Export the policy in eval mode to ONNX (inputs 'qpos', 'image'; output 'actions') for ONNX Runtime / TensorRT.
+    Like tracing, the export fixes input shapes to the sample's, so export with the deployment shape."""
+    policy.eval()
+    # A fresh wrapper is in train mode, and export restores the wrapper's mode onto the policy afterwards
+    wrapper = ACTInferenceWrapper(policy).eval()
+    # The dynamo exporter (default in newer torch) can't trace the data-dependent check in transforms.Normalize
+    export_kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(wrapper, (sample_qpos, sample_image), save_path, opset_version=opset_version,
+                          input_names=['qpos', 'image'], output_names=['actions'], **export_kwargs)
+    print(f"Saved ONNX policy to {save_path}")
@@ -3,32 +3,68 @@ import numpy as np
 import torch
 
 
-def set_joint_angles_instantly(robot, angle_dict_to_try):
-    # Enable motor control for all joints
-    num_joints = p.getNumJoints(robot)
-    for joint_idx in range(num_joints):
+# (height, width, device) -> (uint8 HWC host buffer, CUDA event marking its last transfer)
+_frame_staging = {}
+
+
+def get_controlled_joints(robot):
+    """[(joint_idx, joint_name)] of the joints set_joint_angles_instantly drives. Compute once after loadURDF
+    so the control loop doesn't query and decode every joint's info each step."""
+    controlled_joints = []
+    for joint_idx in range(p.getNumJoints(robot)):
         joint_info = p.getJointInfo(robot, joint_idx)
-        # print(joint_info)
         joint_name = joint_info[1].decode('utf-8')
         joint_type = joint_info[2]  # Get joint type
 
-        # Set 0 position for all joints. Only control revolute and prismatic joints.
-        # if joint_type in [p.JOINT_REVOLUTE]:
-        #     p.setJointMotorControl2(robot, joint_idx,
-        #                            controlMode=p.POSITION_CONTROL,
-        #                            targetPosition=0,  # Radians for revolute, meters for prismatic
-        #                            force=100)  # Maximum force in Newtons
-
+        # Only control revolute joints.
         # TODO make head tilt and head pan to move
-        if joint_name in angle_dict_to_try and joint_type in [p.JOINT_REVOLUTE] and joint_name not in ['head_tilt', 'head_pan']:
-            p.setJointMotorControl2(robot, joint_idx,
-                                controlMode=p.POSITION_CONTROL,
-                                positionGain=0.01,
-                                targetPosition=angle_dict_to_try[joint_name],  # Radians for revolute, meters for prismatic
-                                force=500)  # Maximum force in Newtons
+        if joint_type in [p.JOINT_REVOLUTE] and joint_name not in ['head_tilt', 'head_pan']:
+            controlled_joints.append((joint_idx, joint_name))
+    return controlled_joints
+
+
+def set_joint_angles_instantly(robot, angle_dict_to_try, controlled_joints=None, force=500):
+    """controlled_joints: cached get_controlled_joints(robot); looked up on every call if not given
+    force: maximum motor force in Newtons"""
+    if controlled_joints is None:
+        controlled_joints = get_controlled_joints(robot)
+    joint_indices = []
+    target_positions = []
+    for joint_idx, joint_name in controlled_joints:
+        if joint_name in angle_dict_to_try:
+            joint_indices.append(joint_idx)
+            target_positions.append(angle_dict_to_try[joint_name])  # Radians for revolute, meters for prismatic
+    if joint_indices:
+        # One batched call instead of a setJointMotorControl2 per joint
+        p.setJointMotorControlArray(robot, joint_indices,
+                                    controlMode=p.POSITION_CONTROL,
+                                    targetPositions=target_positions,
+                                    positionGains=[0.01] * len(joint_indices),
+                                    forces=[force] * len(joint_indices))
 
 
 def get_dummy_image():
     """Generate black dummy image matching training specs"""
     # Create dummy image tensor: [1, 1, 3, 120, 160] (batch, camera, channels, H, W)
     return torch.zeros(1, 1, 3, 120, 160, dtype=torch.float32)
+
+
+def stage_camera_frame(rgb, device='cpu'):
+    """Move a getCameraImage RGBA frame to device as uint8 HxWx3, via a reused (pinned for CUDA) host buffer.
+
+    Transferring uint8 moves 1 byte per pixel instead of 4; callers convert/permute/normalize on the device.
+    The returned frame is always a new tensor, never the shared staging buffer.
+    """
+    rgb = np.asarray(rgb, dtype=np.uint8)
+    if torch.device(device).type != 'cuda':
+        return torch.from_numpy(rgb[..., :3].copy())  # .to('cpu') would hand back the buffer itself
+    height, width = rgb.shape[:2]
+    key = (height, width, str(device))
+    if key not in _frame_staging:
+        _frame_staging[key] = (torch.empty(height, width, 3, dtype=torch.uint8, pin_memory=True), torch.cuda.Event())
+    host_frame, copied = _frame_staging[key]
+    copied.synchronize()  # the previous non_blocking copy must finish reading before we overwrite
+    np.copyto(host_frame.numpy(), rgb[..., :3])
+    frame = host_frame.to(device, non_blocking=True)
+    copied.record()
+    return frame
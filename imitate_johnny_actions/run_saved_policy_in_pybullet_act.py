@@ -1,15 +1,20 @@
 import argparse
+import os
+import queue
+import threading
 import time
+from contextlib import nullcontext
 from datetime import datetime
 
 import torch
 import pybullet as p
 import pybullet_data
-import numpy as np
 
 # from imitate_johnny_actions.imitate_johnny_action import SimplePolicy, JOINT_ORDER
 from .constants import JOINT_ORDER
-from act_relevant_files.policy import ACTPolicy
+from act_relevant_files.policy import ACTPolicy, IMAGE_MEAN, IMAGE_STD
+from .policy_export import export_onnx
+from .pybullet_utils import set_joint_angles_instantly, get_controlled_joints, get_dummy_image, stage_camera_frame
 
 # TODO see how slow CNN is. profile. Also check GPU and stuff or?
 # TODO how to pytorch AMD?
@@ -17,51 +22,218 @@ from act_relevant_files.policy import ACTPolicy
 
 
 
-def load_policy(checkpoint_path, device='cpu'):
-    """Load trained ACT policy from checkpoint"""
+def inference_autocast(device):
+    """Autocast for policy inference, matching train(): bf16 where supported, else fp16, on CUDA; off on CPU.
+    The weight-cast cache is disabled since each forward uses every weight once (and it breaks CUDA graph capture)."""
+    device = torch.device(device)
+    use_amp = device.type == 'cuda'
+    amp_dtype = torch.bfloat16 if use_amp and torch.cuda.is_bf16_supported() else torch.float16
+    return torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=use_amp, cache_enabled=False)
+
+
+def load_policy(checkpoint_path, device='cpu', compile=False):
+    """Load trained ACT policy from checkpoint.
+
+    compile: torch.compile the model (reduce-overhead). Warm it up on the thread that will run inference
+    (see AsyncPolicyRunner's warmup_inputs); the compile itself is lazy and happens on the first forward.
+    """
     checkpoint = torch.load(checkpoint_path, map_location=device, weights_only=True)
 
     # Create policy from saved config
     policy = ACTPolicy(checkpoint['config'])
     policy.load_state_dict(checkpoint['model_state'])
+    policy.model.strip_vae_encoder()  # CVAE encoder is training-only
     policy.eval()
-    return policy.to(device)
+    policy = policy.to(device)
+    if compile:
+        # In place like build() does for --compile, so state_dict keys are unchanged
+        policy.model.compile(mode="reduce-overhead", dynamic=False)
+    return policy
+
+
+class CUDAGraphPolicy:
+    """Replay a captured CUDA graph of an ACTPolicy's inference forward for fixed input shapes.
+
+    At batch size 1 inference is dominated by kernel launch overhead; one graph replay issues the whole
+    forward at once. New inputs are copied into the static buffers the graph was captured with, and the
+    returned tensor is the static output buffer, overwritten by the next call.
+
+    Only policy.model is captured: ACTPolicy.__call__'s transforms.Normalize builds its mean/std tensors from
+    host lists and checks std on the host, which is not allowed while capturing. The same normalization is
+    applied in __call__ with device-resident mean/std while copying the image into its static buffer.
+    """
+
+    def __init__(self, policy, sample_qpos, sample_image, warmup_steps=3):
+        self.model = policy.model
+        self.mean = torch.tensor(IMAGE_MEAN, device=sample_image.device).view(3, 1, 1)
+        self.std = torch.tensor(IMAGE_STD, device=sample_image.device).view(3, 1, 1)
+        self.static_qpos = sample_qpos.clone()
+        self.static_image = torch.empty_like(sample_image)
+        self._copy_inputs(sample_qpos, sample_image)
+        with torch.no_grad(), inference_autocast(sample_image.device):
+            # Warm up on a side stream so lazy init and cuDNN autotuning are not captured
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(warmup_steps):
+                    self.model(self.static_qpos, self.static_image, None)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            self.graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(self.graph):
+                self.static_out = self.model(self.static_qpos, self.static_image, None)[0]
+
+    def _copy_inputs(self, qpos, image):
+        self.static_qpos.copy_(qpos, non_blocking=True)
+        self.static_image.copy_(image, non_blocking=True).sub_(self.mean).div_(self.std)
+
+    def __call__(self, qpos, image):
+        self._copy_inputs(qpos, image)
+        self.graph.replay()
+        return self.static_out
+
+
+class ONNXPolicy:
+    """Run a policy exported with export_onnx through ONNX Runtime, preferring the TensorRT (fp16) and CUDA
+    execution providers on cuda when onnxruntime has them. Inputs must have the shapes used at export."""
+
+    def __init__(self, onnx_path, device='cpu'):
+        import onnxruntime as ort  # Optional dependency, only needed for --onnx
+        available = ort.get_available_providers()
+        providers = []
+        if torch.device(device).type == 'cuda':
+            if 'TensorrtExecutionProvider' in available:
+                providers.append(('TensorrtExecutionProvider', {'trt_fp16_enable': True}))
+            if 'CUDAExecutionProvider' in available:
+                providers.append('CUDAExecutionProvider')
+        providers.append('CPUExecutionProvider')
+        self.session = ort.InferenceSession(onnx_path, providers=providers)
+
+    def __call__(self, qpos, image):
+        actions = self.session.run(None, {'qpos': qpos.float().cpu().numpy(), 'image': image.float().cpu().numpy()})[0]
+        return torch.from_numpy(actions)
+
+
+class AsyncPolicyRunner:
+    """Run policy inference on a background thread so p.stepSimulation() keeps stepping while the policy runs.
+
+    submit() hands over the newest observation (replacing one the worker hasn't started on) and poll() returns
+    the newest finished (action_array, inference_time) or None, re-raising any error from the worker. On CUDA, inference runs on its own stream after
+    waiting for the work that produced the observation.
 
+    warmup_inputs: (qpos, image) to run warmup_steps forwards with on the worker thread before serving
+    observations. Needed for load_policy(compile=True): reduce-overhead records its CUDA graphs per thread,
+    so a warmup on the main thread would still leave the recording to the first control ticks.
+    """
 
-def get_camera_image(robot, width=240, height=240):
+    def __init__(self, policy, device='cpu', warmup_inputs=None, warmup_steps=2):
+        self.policy = policy
+        self.device = device
+        self.observations = queue.Queue(maxsize=1)
+        self.results = queue.Queue(maxsize=2)
+        self.stream = torch.cuda.Stream() if torch.device(device).type == 'cuda' else None
+        self.warmup = (*warmup_inputs, self._ready_event()) if warmup_inputs is not None else None
+        self.warmup_steps = warmup_steps
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _ready_event(self):
+        if self.stream is None:
+            return None
+        ready = torch.cuda.Event()
+        ready.record()  # on the main thread's stream, after the ops that produced qpos/image
+        return ready
+
+    def submit(self, qpos, image):
+        ready = self._ready_event()
+        try:
+            self.observations.get_nowait()  # drop a stale observation the worker hasn't picked up
+        except queue.Empty:
+            pass
+        self.observations.put_nowait((qpos, image, ready))
+
+    def poll(self):
+        result = None
+        while True:  # only the newest result matters
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                break
+        if isinstance(result, Exception):
+            raise RuntimeError("Background policy inference failed") from result
+        return result
+
+    def _infer(self, qpos, image, ready):
+        with torch.no_grad(), inference_autocast(self.device), \
+                (torch.cuda.stream(self.stream) if self.stream is not None else nullcontext()):
+            if ready is not None:
+                self.stream.wait_event(ready)
+            return self.policy(qpos, image).float().cpu().numpy().flatten()  # numpy has no bf16
+
+    def _put_result(self, result):
+        if self.results.full():
+            try:
+                self.results.get_nowait()
+            except queue.Empty:
+                pass
+        self.results.put(result)
+
+    def _worker(self):
+        if self.warmup is not None:
+            try:
+                for _ in range(self.warmup_steps):
+                    self._infer(*self.warmup)
+            except Exception as e:
+                self._put_result(e)
+        while True:
+            qpos, image, ready = self.observations.get()
+            start_time = time.time()
+            try:
+                result = (self._infer(qpos, image, ready), time.time() - start_time)
+            except Exception as e:  # surfaced to the main thread by poll()
+                result = e
+            self._put_result(result)
+
+
+# Camera intrinsics are fixed (square 60 deg FOV), so the projection matrix is computed once
+CAMERA_PROJ_MATRIX = p.computeProjectionMatrixFOV(fov=60, aspect=1.0, nearVal=0.1, farVal=10.0)
+_head_links = {}  # robot id -> head_tilt link index
+
+
+def get_camera_image(robot, width=240, height=240, device='cpu'):
     """Get robot's camera view for policy input (preserved for later use)"""
     # Camera position on robot's head (adjust these values based on your URDF)
-    head_link = [i for i in range(p.getNumJoints(robot))
-                if p.getJointInfo(robot, i)[1].decode() == 'head_tilt'][0]
+    if robot not in _head_links:
+        _head_links[robot] = [i for i in range(p.getNumJoints(robot))
+                              if p.getJointInfo(robot, i)[1].decode() == 'head_tilt'][0]
+    head_link = _head_links[robot]
 
     # Get camera position and orientation
-    head_pos = p.getLinkState(robot, head_link)[0]
-    head_orn = p.getLinkState(robot, head_link)[1]
+    head_pos, head_orn = p.getLinkState(robot, head_link)[:2]
     rot_matrix = p.getMatrixFromQuaternion(head_orn)
-    forward_vec = np.array(rot_matrix[6:9])
-    up_vec = np.array(rot_matrix[3:6])
+    hx, hy, hz = head_pos
+    fx, fy, fz = rot_matrix[6:9]  # forward vector
 
-    # Camera parameters
+    # Camera parameters (plain float tuples, no per-frame numpy temporaries)
     view_matrix = p.computeViewMatrix(
-        head_pos + forward_vec * 0.1,  # Camera position (slightly in front of head)
-        head_pos + forward_vec * 2.0,  # Look at point
-        up_vec
-    )
-    proj_matrix = p.computeProjectionMatrixFOV(
-        fov=60, aspect=1.0, nearVal=0.1, farVal=10.0
+        (hx + fx * 0.1, hy + fy * 0.1, hz + fz * 0.1),  # Camera position (slightly in front of head)
+        (hx + fx * 2.0, hy + fy * 2.0, hz + fz * 2.0),  # Look at point
+        rot_matrix[3:6]  # up vector
     )
 
     # Render image
     _, _, rgb, _, _ = p.getCameraImage(
         width=width, height=height,
         viewMatrix=view_matrix,
-        projectionMatrix=proj_matrix,
+        projectionMatrix=CAMERA_PROJ_MATRIX,
+        shadow=0,  # Policy input doesn't need shadows (TinyRenderer flag; OpenGL follows COV_ENABLE_SHADOWS)
+        flags=p.ER_NO_SEGMENTATION_MASK,  # Segmentation mask is never used, skip computing/copying it
         renderer=p.ER_BULLET_HARDWARE_OPENGL
     )
 
-    # Convert to tensor and add camera dimension
-    image = torch.from_numpy(rgb[..., :3].transpose(2, 0, 1)).float() / 255.0
-    return image.unsqueeze(0).unsqueeze(0)  # Shape: [1, 1, 3, H, W] (batch, camera, channels, H, W)
+    # Transfer as uint8, then HWC -> CHW and normalize on the device; add batch and camera dimensions
+    image = stage_camera_frame(rgb, device).permute(2, 0, 1).float().div_(255.0)
+    return image[None, None]  # Shape: [1, 1, 3, H, W] (batch, camera, channels, H, W)
 
 
 if __name__ == "__main__":
@@ -70,10 +242,28 @@ if __name__ == "__main__":
                       help='Path to trained policy checkpoint')
     parser.add_argument('--device', type=str, default='cpu',
                       choices=['cpu', 'cuda'], help='Device to run policy on')
+    parser.add_argument('--compile', action='store_true',
+                      help='torch.compile the policy (reduce-overhead) and warm it up before the control loop')
+    parser.add_argument('--cuda_graph', action='store_true',
+                      help='Capture the policy forward in a CUDA graph and replay it each control tick (cuda only)')
+    parser.add_argument('--onnx', type=str, default=None,
+                      help='Run the policy with ONNX Runtime from this .onnx file, exporting the checkpoint to it first if missing')
     args = parser.parse_args()
 
     # Load policy
-    policy = load_policy(args.checkpoint, device=args.device).to(args.device)
+    policy = load_policy(args.checkpoint, device=args.device, compile=args.compile)
+    if args.onnx:
+        if args.compile or args.cuda_graph:
+            raise ValueError("--onnx replaces the PyTorch policy; don't combine it with --compile or --cuda_graph")
+        if not os.path.exists(args.onnx):
+            # Export with the shapes the control loop feeds
+            export_onnx(policy, torch.zeros(1, 24, device=args.device), get_dummy_image().to(args.device), args.onnx)
+        policy = ONNXPolicy(args.onnx, device=args.device)
+    if args.cuda_graph:
+        if args.device != 'cuda' or args.compile:
+            raise ValueError("--cuda_graph needs --device cuda and is redundant with --compile (reduce-overhead already uses CUDA graphs)")
+        # Inputs must keep these shapes for the whole run
+        policy = CUDAGraphPolicy(policy, torch.zeros(1, 24, device=args.device), get_dummy_image().to(args.device))
 
 
     physicsClient = p.connect(p.GUI)
@@ -81,7 +271,8 @@ if __name__ == "__main__":
     p.setGravity(0, 0, -9.81)
     # p.setGravity(0, 0, 0)
 
-    p.configureDebugVisualizer(p.COV_ENABLE_SHADOWS, 1, lightPosition=[1, 1, 1])
+    # Shadow maps dominate OpenGL render time for the small policy camera and add nothing to its input
+    p.configureDebugVisualizer(p.COV_ENABLE_SHADOWS, 0, lightPosition=[1, 1, 1])
     planeId = p.loadURDF("plane.urdf")
 
     # Load robot URDF
@@ -89,6 +280,7 @@ if __name__ == "__main__":
     # use_fixed_base = True
     urdf_path = "/home/ben/all_projects/ainex_private_ws/ainex_private/src/ainex_simulations/ainex_description/urdf/ainex.urdf"
     robot = p.loadURDF(urdf_path, [0, 0, 0.25], useFixedBase=use_fixed_base)  # Start above ground
+    controlled_joints = get_controlled_joints(robot)
 
     # Add action buffer for sequence prediction
     pred_steps = 3
@@ -98,35 +290,35 @@ if __name__ == "__main__":
 
     # Initialize joint targets with neutral position
     joint_targets = {name: 0.0 for name in JOINT_ORDER}
+    # Inference runs in the background; the loop keeps stepping with the last targets until new actions arrive
+    # With --compile, warm up on the inference thread with the shapes the control loop feeds
+    warmup_inputs = (torch.zeros(1, 24, device=args.device), get_dummy_image().to(args.device)) if args.compile else None
+    inference = AsyncPolicyRunner(policy, device=args.device, warmup_inputs=warmup_inputs)
 
     while True:
         current_time = time.time()
 
-        # Get observations - USING DUMMY IMAGE FOR NOW
-        image = get_dummy_image().to(args.device)  # Switch to get_camera_image() when ready
-        qpos = torch.zeros(1, 24).to(args.device)  # Replace with actual qpos if available
-
-        # Run policy at control interval
+        # Query policy at control interval; observations are only rendered/built when the policy consumes them
         if current_time - last_control_time > control_interval:
-            start_time = time.time()
-            with torch.no_grad():
-                action_output = policy(qpos, image)
-                action_array = action_output.cpu().numpy().flatten()  # Force to 1D array
-                print(f"Action output shape: {action_output.shape}")  # Debug
+            # Get observations - USING DUMMY IMAGE FOR NOW
+            image = get_dummy_image().to(args.device)  # Switch to get_camera_image() when ready
+            qpos = torch.zeros(1, 24).to(args.device)  # Replace with actual qpos if available
+            inference.submit(qpos, image)
+            last_control_time = current_time
 
-                # Ensure we have 24 elements (one per joint)
-                if len(action_array) != 24:
-                    raise ValueError(f"Expected 24 action values, got {len(action_array)}")
+        result = inference.poll()
+        if result is not None:
+            action_array, inference_time = result
+            # Ensure we have 24 elements (one per joint)
+            if len(action_array) != 24:
+                raise ValueError(f"Expected 24 action values, got {len(action_array)}")
 
             # Directly map to joint targets
             joint_targets = {name: action_array[i] for i, name in enumerate(JOINT_ORDER)}
             print("Sample joint targets:", {k: f"{v:.3f}" for k,v in list(joint_targets.items())[:3]})
-
-            inference_time = time.time() - start_time
             print(f"Policy inference took: {inference_time:.3f}s")
-            last_control_time = current_time
 
         # Apply to simulation (now using initialized joint_targets)
-        set_joint_angles_instantly(robot, joint_targets)
+        set_joint_angles_instantly(robot, joint_targets, controlled_joints)
         p.stepSimulation()
         time.sleep(1./240.)
@@ -5,10 +5,10 @@ from datetime import datetime
 import torch
 import pybullet as p
 import pybullet_data
-import numpy as np
 
 # from imitate_johnny_actions.imitate_johnny_action import SimplePolicy, JOINT_ORDER
 from imitate_johnny_actions.imitate_johnny_action_simple_model import SequencePolicy, JOINT_ORDER
+from imitate_johnny_actions.pybullet_utils import stage_camera_frame, get_controlled_joints, set_joint_angles_instantly
 
 
 def load_policy(checkpoint_path, device='cpu'):
@@ -25,66 +25,47 @@ def load_policy(checkpoint_path, device='cpu'):
     return policy
 
 
-def get_camera_image(robot, width=240, height=240):
+# Camera intrinsics are fixed (square 60 deg FOV), so the projection matrix is computed once
+CAMERA_PROJ_MATRIX = p.computeProjectionMatrixFOV(fov=60, aspect=1.0, nearVal=0.1, farVal=10.0)
+_head_links = {}  # robot id -> head_tilt link index
+
+
+def get_camera_image(robot, width=240, height=240, device='cpu'):
     """Get robot's camera view for policy input"""
     # Camera position on robot's head (adjust these values based on your URDF)
-    head_link = [i for i in range(p.getNumJoints(robot))
-                if p.getJointInfo(robot, i)[1].decode() == 'head_tilt'][0]
+    if robot not in _head_links:
+        _head_links[robot] = [i for i in range(p.getNumJoints(robot))
+                              if p.getJointInfo(robot, i)[1].decode() == 'head_tilt'][0]
+    head_link = _head_links[robot]
 
     # Get camera position and orientation
-    head_pos = p.getLinkState(robot, head_link)[0]
-    head_orn = p.getLinkState(robot, head_link)[1]
+    head_pos, head_orn = p.getLinkState(robot, head_link)[:2]
     rot_matrix = p.getMatrixFromQuaternion(head_orn)
-    forward_vec = np.array(rot_matrix[6:9])
-    up_vec = np.array(rot_matrix[3:6])
+    hx, hy, hz = head_pos
+    fx, fy, fz = rot_matrix[6:9]  # forward vector
 
-    # Camera parameters
+    # Camera parameters (plain float tuples, no per-frame numpy temporaries)
     view_matrix = p.computeViewMatrix(
-        head_pos + forward_vec * 0.1,  # Camera position (slightly in front of head)
-        head_pos + forward_vec * 2.0,  # Look at point
-        up_vec
-    )
-    proj_matrix = p.computeProjectionMatrixFOV(
-        fov=60, aspect=1.0, nearVal=0.1, farVal=10.0
+        (hx + fx * 0.1, hy + fy * 0.1, hz + fz * 0.1),  # Camera position (slightly in front of head)
+        (hx + fx * 2.0, hy + fy * 2.0, hz + fz * 2.0),  # Look at point
+        rot_matrix[3:6]  # up vector
     )
 
     # Render image
     _, _, rgb, _, _ = p.getCameraImage(
         width=width, height=height,
         viewMatrix=view_matrix,
-        projectionMatrix=proj_matrix,
+        projectionMatrix=CAMERA_PROJ_MATRIX,
+        shadow=0,  # Policy input doesn't need shadows (TinyRenderer flag; OpenGL follows COV_ENABLE_SHADOWS)
+        flags=p.ER_NO_SEGMENTATION_MASK,  # Segmentation mask is never used, skip computing/copying it
         renderer=p.ER_BULLET_HARDWARE_OPENGL
     )
 
-    # Convert to tensor and normalize
-    image = torch.from_numpy(rgb[..., :3].transpose(2, 0, 1)).float() / 255.0
+    # Transfer as uint8, then HWC -> CHW and normalize on the device
+    image = stage_camera_frame(rgb, device).permute(2, 0, 1).float().div_(255.0)
     return image.unsqueeze(0)  # Add batch dimension
 
 
-def set_joint_angles_instantly(robot, angle_dict_to_try):
-    # Enable motor control for all joints
-    num_joints = p.getNumJoints(robot)
-    for joint_idx in range(num_joints):
-        joint_info = p.getJointInfo(robot, joint_idx)
-        # print(joint_info)
-        joint_name = joint_info[1].decode('utf-8')
-        joint_type = joint_info[2]  # Get joint type
-
-        # Set 0 position for all joints. Only control revolute and prismatic joints.
-        # if joint_type in [p.JOINT_REVOLUTE]:
-        #     p.setJointMotorControl2(robot, joint_idx,
-        #                            controlMode=p.POSITION_CONTROL,
-        #                            targetPosition=0,  # Radians for revolute, meters for prismatic
-        #                            force=100)  # Maximum force in Newtons
-
-        # TODO make head tilt and head pan to move
-        if joint_name in angle_dict_to_try and joint_type in [p.JOINT_REVOLUTE] and joint_name not in ['head_tilt', 'head_pan']:
-            p.setJointMotorControl2(robot, joint_idx,
-                                controlMode=p.POSITION_CONTROL,
-                                positionGain=0.01,
-                                targetPosition=angle_dict_to_try[joint_name],  # Radians for revolute, meters for prismatic
-                                force=100)  # Maximum force in Newtons
-
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--checkpoint', type=str, required=True,
@@ -102,7 +83,8 @@ if __name__ == "__main__":
     p.setGravity(0, 0, -9.81)
     # p.setGravity(0, 0, 0)
 
-    p.configureDebugVisualizer(p.COV_ENABLE_SHADOWS, 1, lightPosition=[1, 1, 1])
+    # Shadow maps dominate OpenGL render time for the small policy camera and add nothing to its input
+    p.configureDebugVisualizer(p.COV_ENABLE_SHADOWS, 0, lightPosition=[1, 1, 1])
     planeId = p.loadURDF("plane.urdf")
 
     # Load robot URDF
@@ -110,6 +92,7 @@ if __name__ == "__main__":
     # use_fixed_base = True
     urdf_path = "/home/ben/all_projects/ainex_private_ws/ainex_private/src/ainex_simulations/ainex_description/urdf/ainex.urdf"
     robot = p.loadURDF(urdf_path, [0, 0, 0.25], useFixedBase=use_fixed_base)  # Start above ground
+    controlled_joints = get_controlled_joints(robot)
 
     # Add action buffer for sequence prediction
     pred_steps = 3
@@ -120,13 +103,13 @@ if __name__ == "__main__":
     while True:
         current_time = time.time()
 
-        # Get observations
-        image = get_camera_image(robot).to(args.device)
-        qpos = torch.zeros(1, 24).to(args.device)  # Replace with actual qpos if available
-        # TODO should the above change or not? what happened during training?
-
-        # Run policy at control interval
+        # Run policy at control interval; the camera is only rendered on these ticks
         if current_time - last_control_time > control_interval or not action_buffer:
+            # Get observations
+            image = get_camera_image(robot, device=args.device)
+            qpos = torch.zeros(1, 24).to(args.device)  # Replace with actual qpos if available
+            # TODO should the above change or not? what happened during training?
+
             start_time = time.time()
             with torch.no_grad():
                 target_sequence = policy(image, qpos).cpu().numpy()[0]
@@ -144,7 +127,7 @@ if __name__ == "__main__":
             action_buffer = action_buffer[1:]  # Move to next action in sequence
 
         # Apply to simulation
-        set_joint_angles_instantly(robot, joint_targets)
+        set_joint_angles_instantly(robot, joint_targets, controlled_joints, force=100)
 
         p.stepSimulation()
         time.sleep(1./240.)
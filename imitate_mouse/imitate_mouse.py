@@ -2,7 +2,6 @@ import os
 import time
 import sys
 from datetime import datetime
-from collections import deque
 import glob
 
 import numpy as np
@@ -29,7 +28,11 @@ class MouseRecorder:
     """Records mouse movements and screen content"""
     def __init__(self, screen_region=(0, 0, 1920, 1080), history_length=3, use_dummy=False):
         self.screen_region = screen_region
-        self.history = deque(maxlen=history_length)
+        # Ring buffer of the last history_length frames, allocated once the frame size is known
+        self.history_length = history_length
+        self.hist = None
+        self.widx = 0  # next slot to write
+        self.count = 0  # frames written since the last clear_history()
         self.recording = False
         self.data = {
             'images': [],
@@ -39,6 +42,49 @@ class MouseRecorder:
         self.use_dummy = use_dummy
         self.dummy_size = (64, 64)  # Smaller dummy images
         self.dummy_pos = (960, 540)  # Center position for dummy mode
+        self._sct = None  # mss screen grabber; resolved on first grab, False if mss isn't installed
+
+
+    def grab_screen(self):
+        """RGB screenshot of screen_region. Uses mss (X shm / DXGI grab, no subprocess) when installed,
+        otherwise pyautogui.screenshot, which forks a screenshot tool per frame on Linux."""
+        if self._sct is None:  # Pick the backend once; a failed import isn't cached, so don't retry it per frame
+            try:
+                import mss  # Optional dependency
+                self._sct = mss.mss()
+            except ImportError:
+                self._sct = False
+        if self._sct is False:
+            import pyautogui
+            return pyautogui.screenshot(region=self.screen_region)
+        left, top, width, height = self.screen_region
+        raw = np.asarray(self._sct.grab({'left': left, 'top': top, 'width': width, 'height': height}))  # BGRA
+        return raw[:, :, 2::-1]  # BGRA -> RGB view, same channel order as pyautogui
+
+
+    def push_frame(self, img):
+        img = np.asarray(img)
+        if self.hist is None or self.hist.shape[1:] != img.shape:
+            self.hist = np.empty((self.history_length, *img.shape), dtype=np.uint8)
+            self.clear_history()
+        self.hist[self.widx] = img
+        self.widx = (self.widx + 1) % self.history_length
+        self.count += 1
+
+
+    def history_full(self):
+        return self.count >= self.history_length
+
+
+    def stacked_history(self, out=None):
+        """History oldest -> newest as [T, H, W, C], written into out if given"""
+        order = (self.widx + np.arange(self.history_length)) % self.history_length
+        return np.take(self.hist, order, axis=0, out=out)
+
+
+    def clear_history(self):
+        self.widx = 0
+        self.count = 0
 
 
     def start_recording(self):
@@ -60,18 +106,18 @@ class MouseRecorder:
         else:
             try:
                 import pyautogui  # Moved import inside conditional
-                img = pyautogui.screenshot(region=self.screen_region)
+                img = self.grab_screen()
                 pos = pyautogui.position()
             except Exception as e:
                 print(f"GUI access failed: {str(e)}")
                 return
 
         # Store in history
-        self.history.append(img)
+        self.push_frame(img)
 
         # Only save when history is full
-        if len(self.history) == self.history.maxlen:
-            self.data['images'].append(np.stack(self.history))
+        if self.history_full():
+            self.data['images'].append(self.stacked_history())
             self.data['positions'].append(pos)
             self.data['timestamps'].append(time.time())
 
@@ -105,19 +151,33 @@ def circular_mouse_controller(radius=300, speed=2, duration=10, use_dummy=False)
 
 
 class MouseACTDataset(Dataset):
+    """recordings is either a dict of in-memory 'images'/'positions' arrays or a path to an HDF5 file
+    with the same datasets. HDF5 frames are read lazily per sample, so only positions are held in RAM."""
     def __init__(self, recordings, image_size=64, screen_size=(1920, 1080)):
         # Add resize transform
         self.resize = transforms.Resize((image_size, image_size))
 
-        # Fix dummy image dimensions
-        if isinstance(recordings['images'], np.ndarray) and recordings['images'].dtype == np.float64:
-            recordings['images'] = recordings['images'].astype(np.float32)
-
-        self.images = torch.stack([
-            self.resize(torch.tensor(img).float().permute(0, 3, 1, 2))  # Now using defined resize
-            for img in recordings['images']
-        ]) / 255.0
-        self.positions = torch.tensor(recordings['positions'], dtype=torch.float32)
+        self.h5_path = None
+        self._h5_file = None  # opened on first __getitem__, i.e. separately inside each DataLoader worker
+        if isinstance(recordings, (str, os.PathLike)):
+            self.h5_path = recordings
+            with h5py.File(self.h5_path, 'r') as f:
+                positions = f['positions'][:]
+            self.images = None
+        else:
+            positions = recordings['positions']
+
+            # Fix dummy image dimensions
+            if isinstance(recordings['images'], np.ndarray) and recordings['images'].dtype == np.float64:
+                recordings['images'] = recordings['images'].astype(np.float32)
+
+            # Keep uint8 frames as uint8 (4x less memory than float32); __getitem__ scales one sample at a time
+            # Resizing a permuted HWC frame keeps channels-last strides; make the stack dense (N, T, C, H, W) once here
+            # so every __getitem__ slice is a contiguous CHW view and the float conversion reads memory linearly
+            self.images = torch.stack([self.prepare_frames(img) for img in recordings['images']]).contiguous()
+            if self.images.dtype != torch.uint8:
+                self.images = self.images.float()
+        self.positions = torch.tensor(positions, dtype=torch.float32)
         self.positions[:, 0] /= screen_size[0]  # Normalize X
         self.positions[:, 1] /= screen_size[1]  # Normalize Y
 
@@ -125,16 +185,30 @@ class MouseACTDataset(Dataset):
         self.qpos = self.positions.clone()
 
 
+    def prepare_frames(self, img):
+        """[T, H, W, C] frame history -> resized [T, C, H, W] tensor, dtype unchanged"""
+        return self.resize(torch.as_tensor(img).permute(0, 3, 1, 2))
+
+
     def __len__(self):
-        return len(self.images)
+        return len(self.positions)
 
 
     def __getitem__(self, idx):
-        frames = self.images[idx]
+        if self.images is None:
+            if self._h5_file is None:
+                self._h5_file = h5py.File(self.h5_path, 'r')
+            frames = self.prepare_frames(self._h5_file['images'][idx]).contiguous()
+        else:
+            frames = self.images[idx]
+        frames = frames.float() / 255.0
         return frames, self.qpos[idx], self.positions[idx], torch.zeros(1, dtype=torch.bool)
 
 
-def train_mouse_policy(args_dict, device='cuda'):
+def train_mouse_policy(args_dict, device=None):
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
     # Initialize WandB with hyperparameters
     wandb.init(
         project="imitate_mouse",
@@ -190,9 +264,8 @@ def train_mouse_policy(args_dict, device='cuda'):
             'positions': positions.astype(np.float32)
         }
     else:
-        # Original loading code
-        with h5py.File('mouse_demo.hdf5', 'r') as f:
-            recordings = {'images': f['images'][:], 'positions': f['positions'][:]}
+        # Frames stay on disk and are read per sample by the DataLoader workers
+        recordings = 'mouse_demo.hdf5'
 
     # Optional: Replace with black frames
     if args_dict.get('use_dummy_images'):
@@ -201,7 +274,9 @@ def train_mouse_policy(args_dict, device='cuda'):
         recordings['images'] = dummy_images
 
     dataset = MouseACTDataset(recordings)
-    loader = DataLoader(dataset, batch_size=8, shuffle=True, num_workers=2, persistent_workers=True)
+    # Pinned batches let the .to(device, non_blocking=True) copies below overlap with compute on CUDA
+    loader = DataLoader(dataset, batch_size=8, shuffle=True, num_workers=2, persistent_workers=True,
+                        pin_memory=torch.device(device).type == 'cuda')
 
     # ACT policy config
     policy_config = {
@@ -236,10 +311,10 @@ def train_mouse_policy(args_dict, device='cuda'):
 
         progress = tqdm(loader, desc=f'Epoch {epoch}', unit='batch')
         for batch_idx, (images, qpos, actions, is_pad) in enumerate(progress):
-            images = images.to(device)
-            qpos = qpos.to(device)
-            actions = actions.to(device)
-            is_pad = is_pad.to(device)
+            images = images.to(device, non_blocking=True)
+            qpos = qpos.to(device, non_blocking=True)
+            actions = actions.to(device, non_blocking=True)
+            is_pad = is_pad.to(device, non_blocking=True)
 
             # Forward pass
             loss_dict = policy(qpos, images, actions, is_pad)
@@ -300,8 +375,8 @@ def train_mouse_policy(args_dict, device='cuda'):
         # Print sample predictions
         with torch.no_grad():
             sample_images, sample_qpos, sample_actions, sample_is_pad = next(iter(loader))
-            sample_images = sample_images.to(device)
-            sample_qpos = sample_qpos.to(device)
+            sample_images = sample_images.to(device, non_blocking=True)
+            sample_qpos = sample_qpos.to(device, non_blocking=True)
 
             # Direct model call for inference
             a_hat, _, _ = policy.model(sample_qpos, sample_images, env_state=None)
@@ -379,8 +454,8 @@ def train_mouse_policy(args_dict, device='cuda'):
         all_preds = []
         with torch.no_grad():
             for images, qpos, actions, _ in loader:
-                images = images.to(device)
-                qpos = qpos.to(device)
+                images = images.to(device, non_blocking=True)
+                qpos = qpos.to(device, non_blocking=True)
                 preds = policy(qpos, images).cpu().numpy()
                 all_targets.append(actions.numpy())
                 all_preds.append(preds)
@@ -32,36 +32,45 @@ def run_policy_eval(args, num_steps=100):
      # Create policy from saved config
     policy = ACTPolicy(checkpoint['config'])
     policy.load_state_dict(checkpoint['model_state_dict'])
+    policy.model.fuse_backbone_batchnorm()  # Inference only, fold BN into the backbone convs
     policy.eval()
     policy.to(device)
+    if getattr(args, "int8", False):
+        if device != "cpu":
+            raise ValueError("--int8 quantization only runs on CPU, pass --cpu")
+        # int8 weights + dynamically quantized activations for the transformer Linears (fbgemm/x86 kernels)
+        policy.model = torch.ao.quantization.quantize_dynamic(policy.model, {torch.nn.Linear}, dtype=torch.qint8)
 
     recorder = MouseRecorder()
     recorder.start_recording()
 
+    # Reused across steps: uint8 frame history (pinned on CUDA), allocated once the frame size is known
+    frames_buf = None
+    qpos = torch.zeros(1, 2, device=device)  # Dummy qpos (matches training setup)
+
     try:
         for _ in range(num_steps):
             # Generate dummy black frames if requested
             if args.dummy:
                 black_frame = np.zeros((240, 240, 3), dtype=np.uint8)
-                for _ in range(recorder.history.maxlen):
-                    recorder.history.append(black_frame)
+                for _ in range(recorder.history_length):
+                    recorder.push_frame(black_frame)
             else:
                 recorder.capture_frame()
 
-            if len(recorder.history) < recorder.history.maxlen:
+            if not recorder.history_full():
                 continue
 
-            # Convert history to tensor
-            current_frame = np.stack(recorder.history)
-            input_tensor = torch.from_numpy(current_frame).float() / 255.0
-            input_tensor = input_tensor.permute(0, 3, 1, 2).to(device)  # [T, C, H, W]
-
-            # Dummy qpos (matches training setup)
-            qpos = torch.zeros(2).to(device).unsqueeze(0)  # Add batch dimension
+            # Copy the history ring buffer in temporal order into the persistent uint8 buffer, then convert/normalize on the device
+            frame_shape = recorder.hist.shape  # [T, H, W, C]
+            if frames_buf is None or tuple(frames_buf.shape) != frame_shape:
+                frames_buf = torch.empty(frame_shape, dtype=torch.uint8, pin_memory=(device == "cuda"))
+            recorder.stacked_history(out=frames_buf.numpy())
 
-            with torch.no_grad():
+            with torch.inference_mode():
+                input_tensor = frames_buf.to(device, non_blocking=True).permute(0, 3, 1, 2).float().div_(255.0)  # [T, C, H, W]
                 action = policy(qpos, input_tensor.unsqueeze(0))
-                pred_normalized = action[0].cpu().numpy()
+                pred_normalized = action[0].cpu().numpy()  # syncs, so frames_buf is free to reuse next step
 
             pred_x = int(pred_normalized[0] * pyautogui.size().width)
             pred_y = int(pred_normalized[1] * pyautogui.size().height)
@@ -69,7 +78,7 @@ def run_policy_eval(args, num_steps=100):
             print(f"Moving mouse to ({pred_x}, {pred_y})")
 
             if args.dummy:
-                recorder.history.clear()  # Reset for next batch
+                recorder.clear_history()  # Reset for next batch
 
     except KeyboardInterrupt:
         recorder.stop_recording()
@@ -84,6 +93,9 @@ if __name__ == "__main__":
         "--dummy", action="store_true", help="Use dummy black screen input"
     )
     parser.add_argument("--cpu", action="store_true", help="Force CPU usage")
+    parser.add_argument(
+        "--int8", action="store_true", help="Quantize Linear layers to int8 for CPU inference"
+    )
     args = parser.parse_args()
 
     run_policy_eval(args)
@@ -29,7 +29,7 @@ sys.path += [
 sys.path.append(os.path.join(path_to_root, 'act_relevant_files'))
 
 # Import your model and helper functions
-from act_relevant_files.detr.models.detr_vae import DETRVAE
+from act_relevant_files.detr.models.detr_vae import DETRVAE, get_sinusoid_encoding_table
 from act_relevant_files.policy import ACTPolicy, kl_divergence
 from act_relevant_files.detr.main import get_args_parser
 
@@ -425,6 +425,20 @@ def test_positional_embedding_alignment():
     assert model.pos_table.shape == (1, num_queries, hidden_dim)
 
 
+# Test 7b: Vectorized sinusoid table matches the reference per-element formula
+@pytest.mark.parametrize("n_position, d_hid", [(5, 512), (7, 33)])
+def test_sinusoid_encoding_table_matches_reference(n_position, d_hid):
+    reference = np.array([[pos / np.power(10000, 2 * (j // 2) / d_hid) for j in range(d_hid)]
+                          for pos in range(n_position)])
+    reference[:, 0::2] = np.sin(reference[:, 0::2])
+    reference[:, 1::2] = np.cos(reference[:, 1::2])
+
+    table = get_sinusoid_encoding_table(n_position, d_hid)
+    assert table.shape == (1, n_position, d_hid)
+    assert table.dtype == torch.float32
+    assert np.allclose(table[0].numpy(), reference, atol=1e-5)
+
+
 # Test 8: Full DETRVAE Forward Pass Integration Test with Dummy Backbone
 def test_full_detrvae_integration():
     batch = 2
@@ -744,12 +758,58 @@ def test_mouse_policy_inference_shape():
         assert output.shape == (1, 2), f"Unexpected output shape {output.shape}"
 
 
+def test_mouse_recorder_ring_buffer_history_order():
+    """Ring buffer history comes back oldest -> newest and recorded samples don't alias it"""
+    from imitate_mouse.imitate_mouse import MouseRecorder
+
+    recorder = MouseRecorder(history_length=3, use_dummy=True)
+    for i in range(5):
+        recorder.push_frame(np.full((4, 4, 3), i, dtype=np.uint8))
+    assert recorder.history_full()
+    assert recorder.stacked_history()[:, 0, 0, 0].tolist() == [2, 3, 4]
+
+    out = np.empty((3, 4, 4, 3), dtype=np.uint8)
+    recorder.stacked_history(out=out)
+    assert out[:, 0, 0, 0].tolist() == [2, 3, 4]
+
+    recorder.clear_history()
+    assert not recorder.history_full()
+
+    recorder.start_recording()
+    for _ in range(4):
+        recorder.capture_frame()
+    assert len(recorder.data['images']) == 2
+    assert recorder.data['images'][0].shape == (3, 64, 64, 3)
+    assert recorder.data['images'][0] is not recorder.data['images'][1]
+
+
+def test_mouse_dataset_lazy_hdf5_matches_in_memory(tmp_path):
+    """Reading frames per sample from HDF5 gives the same samples as loading everything up front"""
+    import h5py
+    from imitate_mouse.imitate_mouse import MouseACTDataset
+
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 255, (5, 3, 80, 100, 3), dtype=np.uint8)
+    positions = rng.uniform(0, 1000, (5, 2)).astype(np.float32)
+    h5_path = tmp_path / 'mouse_demo.hdf5'
+    with h5py.File(h5_path, 'w') as f:
+        f['images'] = images
+        f['positions'] = positions
+
+    in_memory = MouseACTDataset({'images': images, 'positions': positions})
+    lazy = MouseACTDataset(str(h5_path))
+    assert lazy.images is None and len(lazy) == len(in_memory)
+    for idx in range(len(lazy)):
+        for expected, actual in zip(in_memory[idx], lazy[idx]):
+            assert torch.equal(expected, actual)
+
+
 def test_pybullet_simulation_smoke():
     with patch('pybullet.connect'), \
          patch('pybullet.loadURDF'), \
          patch('pybullet.getNumJoints') as mock_joints, \
          patch('pybullet.getJointInfo') as mock_joint_info, \
-         patch('pybullet.setJointMotorControl2'):
+         patch('pybullet.setJointMotorControlArray'):
 
         mock_joints.return_value = 2
         mock_joint_info.side_effect = [
@@ -854,6 +914,168 @@ def test_johnny_policy_save_load_inference():
 
 
 
+def test_strip_vae_encoder_keeps_inference_output():
+    """Stripping the training-only CVAE encoder must not change inference predictions"""
+    policy_config = {
+        'num_queries': 1,
+        'kl_weight': 1,
+        'device': 'cpu',
+        'num_actions': 24,
+        'state_dim': 24,
+        'hidden_dim': 32,
+        'dim_feedforward': 64,
+        'enc_layers': 2,
+        'dec_layers': 2,
+        'nheads': 2,
+        'camera_names': ['dummy'],
+    }
+    policy = ACTPolicy(policy_config)
+    policy.eval()
+    qpos = torch.randn(2, 24)
+    image = torch.rand(2, 1, 3, 64, 64)
+    with torch.no_grad():
+        expected = policy(qpos, image)
+
+    policy.model.strip_vae_encoder()
+    assert policy.model.encoder is None
+    assert not any(k.startswith('model.encoder.') for k in policy.state_dict())
+    with torch.no_grad():
+        assert torch.equal(policy(qpos, image), expected)
+
+    with pytest.raises(RuntimeError):
+        policy(qpos, image, torch.randn(2, 24), torch.zeros(2, dtype=torch.bool))
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="Requires CUDA")
+def test_cuda_graph_policy_capture_and_replay():
+    """The ACT inference forward can be captured in a CUDA graph and replays to the eager output"""
+    from imitate_johnny_actions.run_saved_policy_in_pybullet_act import CUDAGraphPolicy, inference_autocast
+
+    policy_config = {
+        'num_queries': 1,
+        'kl_weight': 1,
+        'device': 'cuda',
+        'num_actions': 24,
+        'state_dim': 24,
+        'hidden_dim': 32,
+        'dim_feedforward': 64,
+        'enc_layers': 2,
+        'dec_layers': 2,
+        'nheads': 2,
+        'camera_names': ['dummy'],
+    }
+    policy = ACTPolicy(policy_config).cuda()
+    policy.eval()
+    qpos = torch.randn(1, 24, device='cuda')
+    image = torch.rand(1, 1, 3, 120, 160, device='cuda')
+
+    graph_policy = CUDAGraphPolicy(policy, torch.zeros_like(qpos), torch.zeros_like(image))
+    replayed = graph_policy(qpos, image).clone()
+    with torch.no_grad(), inference_autocast('cuda'):
+        expected = policy(qpos, image)
+    assert torch.allclose(replayed.float(), expected.float(), atol=1e-3)
+
+
+def test_onnx_export_matches_policy(tmp_path):
+    """ONNX Runtime must reproduce the eager policy's actions, and export must leave the policy in eval mode"""
+    pytest.importorskip('onnxruntime')
+    from imitate_johnny_actions.policy_export import export_onnx
+    from imitate_johnny_actions.run_saved_policy_in_pybullet_act import ONNXPolicy
+
+    policy_config = {
+        'num_queries': 1,
+        'kl_weight': 1,
+        'device': 'cpu',
+        'num_actions': 24,
+        'state_dim': 24,
+        'hidden_dim': 32,
+        'dim_feedforward': 64,
+        'enc_layers': 2,
+        'dec_layers': 2,
+        'nheads': 2,
+        'camera_names': ['dummy'],
+    }
+    policy = ACTPolicy(policy_config)
+    policy.model.strip_vae_encoder()
+    qpos = torch.randn(1, 24)
+    image = torch.rand(1, 1, 3, 120, 160)
+    onnx_path = str(tmp_path / 'act.onnx')
+    export_onnx(policy, qpos, image, onnx_path)
+    assert not policy.training
+
+    with torch.no_grad():
+        expected = policy(qpos, image)
+    actions = ONNXPolicy(onnx_path)(qpos, image)
+    assert actions.shape == (1, 24)
+    assert torch.allclose(actions, expected, atol=1e-4)
+
+
+def test_fuse_backbone_batchnorm_keeps_inference_output():
+    """Folding the frozen batch norms into the backbone convs must not change inference predictions"""
+    from detr.models.backbone import FrozenBatchNorm2d
+
+    policy_config = {
+        'num_queries': 1,
+        'kl_weight': 1,
+        'device': 'cpu',
+        'num_actions': 2,
+        'state_dim': 2,
+        'hidden_dim': 32,
+        'dim_feedforward': 64,
+        'enc_layers': 1,
+        'dec_layers': 1,
+        'nheads': 1,
+        'camera_names': ['dummy'],
+    }
+    policy = ACTPolicy(policy_config)
+    policy.eval()
+    for module in policy.modules():
+        if isinstance(module, FrozenBatchNorm2d):  # non-trivial statistics so the fold actually matters
+            module.weight.uniform_(0.5, 1.5)
+            module.bias.normal_()
+            module.running_mean.normal_()
+            module.running_var.uniform_(0.5, 2.0)
+    qpos = torch.rand(2, 2)
+    image = torch.rand(2, 1, 3, 64, 64)
+    with torch.no_grad():
+        expected = policy(qpos, image)
+
+    policy.model.fuse_backbone_batchnorm()
+    assert not any(isinstance(m, FrozenBatchNorm2d) for m in policy.modules())
+    with torch.no_grad():
+        assert torch.allclose(policy(qpos, image), expected, atol=1e-5)
+
+
+def test_multi_camera_shared_backbone_matches_per_camera():
+    """Batching cameras through the shared backbone must equal running each camera and concatenating on width"""
+    policy_config = {
+        'num_queries': 1,
+        'kl_weight': 1,
+        'device': 'cpu',
+        'num_actions': 24,
+        'state_dim': 24,
+        'hidden_dim': 32,
+        'dim_feedforward': 64,
+        'enc_layers': 2,
+        'dec_layers': 2,
+        'nheads': 2,
+        'camera_names': ['left', 'right'],
+    }
+    policy = ACTPolicy(policy_config)
+    policy.eval()
+    qpos = torch.randn(2, 24)
+    image = torch.rand(2, 2, 3, 64, 64)
+    with torch.no_grad():
+        batched = policy(qpos, image)  # single shared backbone -> batched camera path
+        assert batched.shape == (2, 24)
+
+        # Same weights listed once per camera forces the per-camera loop + cat path in DETRVAE.forward
+        backbone = policy.model.backbones[0]
+        policy.model.backbones = nn.ModuleList([backbone, backbone])
+        per_camera = policy(qpos, image)
+    assert torch.allclose(batched, per_camera)
+
+
 @pytest.mark.skipif(not pybullet.isNumpyEnabled(), reason="Requires PyBullet")
 def test_pybullet_simulation_smoke():
     """Basic smoke test for policy in PyBullet environment"""
@@ -869,7 +1091,7 @@ def test_pybullet_simulation_smoke():
          patch('pybullet.loadURDF'), \
          patch('pybullet.getNumJoints') as mock_joints, \
          patch('pybullet.getJointInfo') as mock_joint_info, \
-         patch('pybullet.setJointMotorControl2'):
+         patch('pybullet.setJointMotorControlArray'):
 
         mock_joints.return_value = 2
         mock_joint_info.side_effect = [
@@ -883,6 +1105,80 @@ def test_pybullet_simulation_smoke():
 
 
 
+def test_async_policy_runner_warms_up_on_worker_thread():
+    """Warmup forwards (e.g. reduce-overhead graph recording, which is per thread) run on the inference thread"""
+    import threading
+    import time
+    from imitate_johnny_actions.run_saved_policy_in_pybullet_act import AsyncPolicyRunner
+
+    calling_threads = []
+
+    def policy(qpos, image):
+        calling_threads.append(threading.current_thread())
+        return qpos * 2
+
+    qpos = torch.ones(1, 24)
+    runner = AsyncPolicyRunner(policy, warmup_inputs=(qpos, torch.zeros(1, 1, 3, 8, 8)), warmup_steps=2)
+    runner.submit(qpos, torch.zeros(1, 1, 3, 8, 8))
+    result = None
+    deadline = time.time() + 10
+    while result is None and time.time() < deadline:
+        result = runner.poll()
+        time.sleep(0.001)
+
+    assert result is not None and np.allclose(result[0], 2.0)
+    assert len(calling_threads) == 3
+    assert all(thread is runner.thread for thread in calling_threads)
+
+
+def test_servo_dataset_rejects_sequences_shorter_than_window():
+    """A short sequence would otherwise silently sample windows from the zero padding"""
+    from imitate_johnny_actions.imitate_johnny_action_act import ServoDataset, _GREET_TENSOR
+
+    dataset = ServoDataset([_GREET_TENSOR, _GREET_TENSOR[:5]], num_samples=16, window_size=5)
+    assert dataset.targets.shape == (16, 5, 24)
+    with pytest.raises(ValueError):
+        ServoDataset([_GREET_TENSOR, _GREET_TENSOR[:3]], num_samples=16, window_size=5)
+
+
+def test_stage_camera_frame_returns_independent_frames():
+    """Staged frames must not alias each other (CPU .to() would otherwise return the shared buffer)"""
+    from imitate_johnny_actions.pybullet_utils import stage_camera_frame
+
+    first = stage_camera_frame(np.full((4, 5, 4), 1, dtype=np.uint8))
+    second = stage_camera_frame(np.full((4, 5, 4), 2, dtype=np.uint8))
+    assert first.shape == (4, 5, 3) and first.dtype == torch.uint8
+    assert int(first.max()) == 1 and int(second.min()) == 2
+
+
+def test_set_joint_angles_uses_cached_controlled_joints():
+    """Joint indices are looked up once; control steps only issue motor commands"""
+    from imitate_johnny_actions.pybullet_utils import get_controlled_joints, set_joint_angles_instantly
+
+    with patch('pybullet.getNumJoints') as mock_joints, \
+         patch('pybullet.getJointInfo') as mock_joint_info, \
+         patch('pybullet.setJointMotorControlArray') as mock_set_joint:
+        mock_joints.return_value = 3
+        mock_joint_info.side_effect = [
+            (0, b'r_hip_yaw', pybullet.JOINT_REVOLUTE),
+            (1, b'head_pan', pybullet.JOINT_REVOLUTE),
+            (2, b'l_gripper', pybullet.JOINT_FIXED),
+        ]
+        controlled_joints = get_controlled_joints(robot=1)
+        assert controlled_joints == [(0, 'r_hip_yaw')]
+
+        for _ in range(3):
+            set_joint_angles_instantly(1, {'r_hip_yaw': 0.5, 'head_pan': 0.1}, controlled_joints)
+        assert mock_joint_info.call_count == 3
+        assert mock_set_joint.call_count == 3  # one batched motor call per step
+        assert mock_set_joint.call_args.args[1] == [0]
+        assert mock_set_joint.call_args.kwargs['targetPositions'] == [0.5]
+        assert mock_set_joint.call_args.kwargs['forces'] == [500]
+
+        set_joint_angles_instantly(1, {'r_hip_yaw': 0.5}, controlled_joints, force=100)
+        assert mock_set_joint.call_args.kwargs['forces'] == [100]
+
+
 @pytest.mark.integration
 def test_mouse_policy_e2e(tmp_path):
     """End-to-enable test of mouse policy training and inference"""